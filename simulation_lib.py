@@ -1,29 +1,60 @@
+import concurrent.futures
+import contextlib
+import json
+import logging
 import subprocess
 import shutil
 import os
+import re
 import sqlite3
+from pathlib import Path
 import pandas as pd
 
+logger = logging.getLogger(__name__)
+
+# Top-level "weather_file" / "seed_file" entries of the workflow template
+_WORKFLOW_RE = re.compile(r'^(  "weather_file"):.*$|^(  "seed_file"):.*$', re.M)
+
+def _fast_clone(src, dst):
+    # The seed archetype is never modified in place, so a hardlink is enough
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        # Cross-device targets or filesystems without hardlink support
+        shutil.copyfile(src, dst)
+
+def _write_workflow_from_template(workflow, weather_file, weather_id, seed_file, path_to_weather, base_path):
+    # json.dumps takes care of escaping the Windows separators inside the workflow
+    weather_path = json.dumps(str(Path(path_to_weather) / weather_file))
+
+    def _sub(match):
+        if match.group(1):
+            return f'{match.group(1)}: {weather_path},'
+        return f'{match.group(2)}:"archtype.osm",'
+
+    # The simulation_results parent is created by the caller, only the run directory is made here
+    dir_path = Path(base_path) / "simulation_results" / f"{weather_id}_{seed_file}"
+    dir_path.mkdir(exist_ok=True)
+    _fast_clone(Path(base_path) / "d_btap" / f"{seed_file}.osm", dir_path / "archtype.osm")
+    path_writing = dir_path / "worflow.osw"
+    # Both substitutions are done in a single pass over the template
+    path_writing.write_text(_WORKFLOW_RE.sub(_sub, workflow), encoding="utf-8")
+    return str(path_writing)
+
 def write_workflow(weather_file, weather_id, seed_file, path_to_workflow, path_to_weather, base_path="."):
-    array_of_strings = []
-    with open(path_to_workflow, "r") as file:
-        for line in file:
-            if '  "weather_file"' in line.split(":"):
-                array_of_strings.append(":".join([line.split(":")[0], f' "{path_to_weather}\\\\{weather_file}",\n']))
-
-            elif '  "seed_file"' in line.split(":"):
-                array_of_strings.append(":".join([line.split(":")[0], f'"archtype.osm",\n']))
-            else:
-                array_of_strings.append(line)
-
-    dir_path = f"{base_path}\\\\simulation_results\\\\{weather_id}_{seed_file}"
-    os.makedirs(dir_path, exist_ok=True)
-    shutil.copy(f"{base_path}\\\\d_btap\\{seed_file}.osm", f"{dir_path}\\\\archtype.osm")
-    path_writing = f"{dir_path}\\\\worflow.osw"
-    with open(path_writing, "w") as file:
-        # Write each string to the file on a new line
-        file.writelines(array_of_strings)  # Add a newline character
-    return path_writing
+    workflow = Path(path_to_workflow).read_text(encoding="utf-8")
+    (Path(base_path) / "simulation_results").mkdir(parents=True, exist_ok=True)
+    return _write_workflow_from_template(workflow, weather_file, weather_id, seed_file, path_to_weather, base_path)
+
+def write_workflows(jobs, path_to_workflow, path_to_weather, base_path=".", max_workers=None):
+    # jobs are (weather_file, weather_id, seed_file) tuples sharing one template read
+    workflow = Path(path_to_workflow).read_text(encoding="utf-8")
+    (Path(base_path) / "simulation_results").mkdir(parents=True, exist_ok=True)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        return list(executor.map(
+            lambda job: _write_workflow_from_template(workflow, *job, path_to_weather, base_path), jobs))
 
 
 def solve(folder_name, software_path):
@@ -34,72 +65,53 @@ def solve(folder_name, software_path):
         "--workflow",
         folder_name,
     ]
-    print(arguments)
+    logger.debug("openstudio arguments: %s", arguments)
     # Run the software with arguments
-    result = subprocess.run([software_path] + arguments, capture_output=True, text=True, shell=True)
+    result = subprocess.run([software_path] + arguments, capture_output=True, text=True)
     return result
 
-def query_eletricity(db_path):
-    # Connect to the SQLite database
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    print(db_path)
-
-    # Query to fetch the entire dataset for "Electricity:Facility"
-    query_full_data = """
-    SELECT TimeIndex, Value 
-    FROM ReportData 
-    WHERE ReportDataDictionaryIndex IN (
-        SELECT ReportDataDictionaryIndex 
-        FROM ReportDataDictionary 
-        WHERE Name = 'ElectricityNet:Facility'
-    );
-    """
-    # Execute the query and fetch the data
-    cursor.execute(query_full_data)
-    full_data = cursor.fetchall()
-    # Create a DataFrame from the data
-    full_df = pd.DataFrame(full_data, columns=['TimeIndex', 'Value (Joules)'])
-    cursor.close()
-    return full_df
+def solve_many(folder_names, software_path, max_workers=None):
+    # Each run is an independent OpenStudio process, the threads only wait on them
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        return list(executor.map(lambda folder_name: solve(folder_name, software_path), folder_names))
+
+# Query to fetch the entire dataset for "Electricity:Facility"
+_ELECTRICITY_QUERY = """
+SELECT TimeIndex, Value
+FROM ReportData
+WHERE ReportDataDictionaryIndex IN (
+    SELECT ReportDataDictionaryIndex
+    FROM ReportDataDictionary
+    WHERE Name = 'ElectricityNet:Facility'
+);
+"""
+
+def _connect(db_path):
+    # Read-only: a missing or not yet written database raises instead of being created empty
+    conn = sqlite3.connect(f"{Path(db_path).resolve().as_uri()}?mode=ro", uri=True)
+    # Serve the scan from a file mapping, it is released when the connection closes
+    conn.execute("PRAGMA mmap_size=1073741824")
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
 
 def query_eletricity(db_path):
-    # Connect to the SQLite database
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    print(db_path)
-
-    # Query to fetch the entire dataset for "Electricity:Facility"
-    query_full_data = """
-    SELECT TimeIndex, Value 
-    FROM ReportData 
-    WHERE ReportDataDictionaryIndex IN (
-        SELECT ReportDataDictionaryIndex 
-        FROM ReportDataDictionary 
-        WHERE Name = 'ElectricityNet:Facility'
-    );
-    """
-
-    # Execute the query and fetch the data
-    cursor.execute(query_full_data)
-    full_data = cursor.fetchall()
-    # Create a DataFrame from the data
-    full_df = pd.DataFrame(full_data, columns=['TimeIndex', 'Value (Joules)'])
-    cursor.close()
+    logger.debug("querying %s", db_path)
+    # Let pandas build the DataFrame directly from the query, then release the result file
+    with contextlib.closing(_connect(db_path)) as conn:
+        full_df = pd.read_sql_query(_ELECTRICITY_QUERY, conn, dtype={'TimeIndex': 'int32', 'Value': 'float32'})
+    full_df.columns = ['TimeIndex', 'Value (Joules)']
     return full_df
 
 # Read CSV file into a DataFrame
-def get_stations_data(weather_station_data,weather_folder, stations):
-    df = pd.read_csv(weather_station_files)
+def get_stations_data(weather_station_data, weather_folder, stations):
+    df = pd.read_csv(weather_station_data)
     quebec_stations_reference = df[df["prov"] == "QC"]
 
-    id_strings = np.array(quebec_stations_reference.loc[weather_zones]["climate_ID"])
-    filenames = os.listdir(weather_folder)
+    id_strings = quebec_stations_reference.loc[stations]["climate_ID"]
+    filenames = pd.Series(os.listdir(weather_folder), dtype=object)
 
-    weather_file_paths = []
-    for elements in filenames:
-        mini_array = elements.split("_")
-        for elem in id_strings:
-            if elem in mini_array:
-                weather_file_paths.append(("_".join(mini_array), elem))
-    return weather_file_paths
\ No newline at end of file
+    # One row per "_"-separated token of each filename, kept when the token is a station id
+    tokens = filenames.str.split("_").explode()
+    matches = tokens[tokens.isin(id_strings)]
+    return list(zip(filenames[matches.index], matches))